@@ -104,7 +104,7 @@ class RIDataset(torch.utils.data.Dataset):
         G = dgl.graph((indices_src, indices_dst))
 
         ### add bond & feature information to graph
-        G.ndata['x'] = torch.unsqueeze(x_0, dim=1)  # [N, 1, 3]
+        G.ndata['x'] = x_0  # [N, 3]
         G.ndata['v'] = torch.unsqueeze(v_0, dim=1)  # [N, 1, 3]
         G.ndata['c'] = torch.unsqueeze(charges, dim=1)  # [N, 1, 1]
         G.edata['d'] = x_0[indices_dst] - x_0[indices_src]  # relative postions
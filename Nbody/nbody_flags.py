@@ -17,6 +17,9 @@ def get_flags():
                         help="Low dimensional embedding fraction")
     parser.add_argument('--head', type=int, default=1,
                         help="Number of attention heads")
+    parser.add_argument('--skip_type', type=str, default='cat', choices=['cat', 'sum', 'gate', 'none'],
+                        help="Skip connection of the attention layers. 'gate' and 'sum' halve the input of the "
+                             "out networks, but change the parameters, so 'cat' checkpoints do not load")
 
     # Meta-parameters
     parser.add_argument('--batch_size', type=int, default=128,
@@ -55,6 +58,16 @@ def get_flags():
                         help="Number of data loader workers")
     parser.add_argument('--profile', action='store_true',
                         help="Exit after 10 steps for profiling")
+    parser.add_argument('--compile', action='store_true',
+                        help="Compile the dense submodules with torch.compile")
+    parser.add_argument('--jit', action='store_true',
+                        help="Script the MLP networks with TorchScript")
+    parser.add_argument('--mixed_precision', action='store_true',
+                        help="Run the attention layers under BF16 autocast")
+    parser.add_argument('--cuda_graph', action='store_true',
+                        help="Replay CUDA graphs of the model forward during evaluation")
+    parser.add_argument('--quantize', action='store_true',
+                        help="Evaluate an int8 quantized CPU copy of the trained model")
 
     # Random seed for both Numpy and Pytorch
     parser.add_argument('--seed', type=int, default=2022)
@@ -1,10 +1,11 @@
+import copy
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 import dgl
 import modules.attn_modules as smp_modules
-from dgl.nn.pytorch.glob import AvgPooling, MaxPooling, SumPooling
 
 embedding_mlp = {
     'layer': 1,    # number of layers.
@@ -19,57 +20,21 @@ embedding_mlp = {
 }
 
 
-query_mlp = {
-    'layer': 2,    # number of layers.
-    'in_LN': False,
-    'hidden': {
-            'dim': 128,    # hidden dimension size
-            'init': 'relu',  # initialization methods. ['kaiming', 'xavier', 'none']
-            'act': nn.ReLU(),
-            'bias': True,
-            'norm': 'LN',
-            'drop': 0.0,
-        },
-    'final': {
-            'init': 'lecun',
-            'bias': True,
-            'act': None,
-            'drop': 0.0,
-        },
-}
-
+# ReLU is stateless, so a single instance is shared by all the MLPs below
+relu = nn.ReLU()
 
-key_mlp = {
+# the query, key-value, skip and readout networks all use the same two-layer architecture
+hidden_mlp = {
     'layer': 2,    # number of layers.
     'in_LN': False,
     'hidden': {
             'dim': 128,    # hidden dimension size
             'init': 'relu',  # initialization methods. ['kaiming', 'xavier', 'none']
-            'act': nn.ReLU(),
+            'act': relu,
             'bias': True,
             'norm': 'LN',
             'drop': 0.0,
         },
-    'final': {
-            'init': 'lecun',
-            'bias': True,
-            'act': None,
-            'drop': 0.0, 
-    },
-}
-
-
-value_mlp = {
-    'layer': 2,    # number of layers.
-    'in_LN': False,
-    'hidden': {
-            'dim': 128,    # hidden dimension size
-            'init': 'relu',  # initialization methods. ['kaiming', 'xavier', 'none']
-            'act': nn.ReLU(),
-            'bias': True,
-            'norm': 'LN',
-            'drop': 0.0, 
-        },
     'final': {
             'init': 'lecun',
             'bias': True,
@@ -78,56 +43,38 @@ value_mlp = {
         },
 }
 
-
-skip_mlp = {
-    'layer': 2,    # number of layers.
-    'in_LN': False,
-    'hidden': {
-            'dim': 128,    # hidden dimension size
-            'init': 'relu',  # initialization methods. ['kaiming', 'xavier', 'none']
-            'act': nn.ReLU(),
-            'bias': True,
-            'norm': 'LN',
-            'drop': 0.0,
-        },
-    'final': {
-            'init': 'lecun',
-            'bias': True,
-            'act': None,
-            'drop': 0.0,
-        },
-}
+query_mlp = hidden_mlp
+key_value_mlp = hidden_mlp
+skip_mlp = hidden_mlp
+out_node_graph_mlp = hidden_mlp
 
 
-out_node_graph_mlp = {
-    'layer': 2,    # number of layers.
-    'in_LN': False,
-    'hidden': {
-            'dim': 128,    # hidden dimension size
-            'init': 'relu',  # initialization methods. ['kaiming', 'xavier', 'none']
-            'act': nn.ReLU(),
-            'bias': True,
-            'norm': 'LN',
-            'drop': 0.0,
-        },
-    'final': {
-            'init': 'lecun',
-            'bias': True,
-            'act': None,
-            'drop': 0.0,
-        },
-}
+@torch.jit.script
+def dropout_residual(x: torch.Tensor, residual: torch.Tensor, p: float, training: bool) -> torch.Tensor:
+    """x + dropout(residual), scripted so that the JIT fuser computes it in a single pass."""
+    return x + F.dropout(residual, p=p, training=training)
 
 
 class NBodyModel(nn.Module):
     """Model for the NBoday simulation experiment."""
     def __init__(self, num_layers: int, num_hidden_channels: int, 
-                 invariant_mod: str, cross_product: bool):
+                 invariant_mod: str, cross_product: bool, skip_type: str = 'cat', use_compile: bool = False,
+                 use_jit: bool = False, mixed_precision: bool = False, fused_kv: bool = True):
         """
         :param num_layers: number of layers.
         :param num_hidden_channels: number of hidden channels.
+        :param skip_type: how the input of each attention layer is combined with its update. 'gate' and 'sum' keep
+            the out networks at the width of the update, 'cat' doubles it. The parameters differ between the types,
+            so a checkpoint only loads into a model with the skip type it was trained with.
+        :param use_compile: compile the dense submodules with torch.compile
+        :param use_jit: script the MLP networks with TorchScript
+        :param mixed_precision: run the attention layers under BF16 autocast
+        :param fused_kv: compute keys and values with one pairwise network. Checkpoints saved before the fusion
+            have separate key_net / value_net parameters and need fused_kv=False to load.
         """
         super(NBodyModel, self).__init__()
+        assert not (use_compile and use_jit), 'use either torch.compile or TorchScript'
+        assert skip_type in ['cat', 'sum', 'gate', 'none']
         self.num_layers = num_layers
         self.invariant_mod = invariant_mod
         self.cross_product = cross_product
@@ -136,66 +83,86 @@ class NBodyModel(nn.Module):
         self.hidden_channels = {'vec': self.hidden_channels, 'scalar': self.hidden_channels}
         self.output_channels = {'vec': 2, 'scalar': 0}
         self.edge_dim = 1
-        self.skip_type = 'cat'
+        self.skip_type = skip_type
         self.input_LN = False
         self.recurrent = True
+        self.use_compile = use_compile
+        self.use_jit = use_jit
+        self.mixed_precision = mixed_precision
+        self.fused_kv = fused_kv
         self._build_network()
         
     def _build_network(self):
-        self.GBlock = nn.ModuleList()
+        layers = []
         m_in = self.input_channels
         m_hidden = self.hidden_channels
         m_out = self.output_channels
         
         recurrent_flag = False
         inputLN_flag = False
+        # separate key and value networks are built when kv_archi is None
+        kv_archi = key_value_mlp if self.fused_kv else None
         
         for _ in range(self.num_layers):
-            self.GBlock.append(
+            layers.append(
                 smp_modules.SO3EquivariantAttenRes(m_in=m_in, m_qk=m_hidden, m_v=m_hidden, m_out=m_hidden,
                                                    invariant_mod = self.invariant_mod,
                                                    cross_product = self.cross_product,
                                                    edge_dim=self.edge_dim, heads=1, recurrent=recurrent_flag, 
                                                    skip_type=self.skip_type, input_LN = inputLN_flag, 
-                                                   q_archi=query_mlp, k_archi=key_mlp, v_archi=value_mlp,
-                                                   out_archi=skip_mlp,))
-            self.GBlock.append(smp_modules.NormBias(m_in=m_hidden, shifted={'vec': 'LN', 'scalar': 'BN'}, 
-                                                    init={'vec': 'rand', 'scalar': 'zero'}))
+                                                   q_archi=query_mlp, kv_archi=kv_archi, k_archi=key_value_mlp,
+                                                   v_archi=key_value_mlp, out_archi=skip_mlp,))
+            layers.append(smp_modules.NormBias(m_in=m_hidden, shifted={'vec': 'LN', 'scalar': 'BN'}, 
+                                               init={'vec': 'rand', 'scalar': 'zero'}))
             m_in = m_hidden
             inputLN_flag = self.input_LN
             recurrent_flag = self.recurrent
             
-        self.GBlock.append(
+        layers.append(
             smp_modules.SO3EquivariantAttenRes(m_in=m_in, m_qk=m_out, m_v=m_out, m_out=m_out,
                                                invariant_mod = self.invariant_mod,
                                                cross_product = self.cross_product,
                                                edge_dim=self.edge_dim, heads=1, recurrent=False, 
                                                skip_type=self.skip_type, input_LN = inputLN_flag, 
-                                               q_archi=query_mlp, k_archi=key_mlp, v_archi=value_mlp,
-                                               out_archi=skip_mlp,))
+                                               q_archi=query_mlp, kv_archi=kv_archi, k_archi=key_value_mlp,
+                                               v_archi=key_value_mlp, out_archi=skip_mlp,))
+        self.GBlock = smp_modules.GraphSequential(*layers)
+
+        if self.use_compile:
+            smp_modules.compile_dense_modules(self)
+        if self.use_jit:
+            smp_modules.script_MLP_networks(self)
         
     def forward(self, G):
-        features = {}
-        features['vec'] = G.ndata['v']
-        G.ndata['x'] = G.ndata['x'][:, 0, :]
-        for layer in self.GBlock:
-            features = layer(features, G=G)
-        return features['vec']
+        features = smp_modules.Feat(vec=G.ndata['v'])
+        with G.local_scope():
+            smp_modules.cache_graph_structure(G)
+            with torch.autocast(device_type=G.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision):
+                features = self.GBlock(features, G)
+        return features.vec.float()
     
     
 class QM9Model(nn.Module):
     """Model for the QM9 experiment."""
 
     def __init__(self, num_layers: int,  invariant_mod: str, cross_product: bool, pooling: str = 'max', heads: int = 1, 
-                 div: int = 1, recurrent: bool = True, hidden_dim:int = 128, skip_type: str = 'cat', input_LN: bool = False):
+                 div: int = 1, recurrent: bool = True, hidden_dim:int = 128, skip_type: str = 'cat', input_LN: bool = False,
+                 use_compile: bool = False, use_jit: bool = False, mixed_precision: bool = False,
+                 fused_kv: bool = True):
         """
         :param num_layers: number of layers
         :param hidden_channgels: number of hidden channels for vectors and scalars
         :param attention_channels: number of channels for vectors and scalars in attentions
         :param heads: attention heads
         :param pooling: pooling layer
+        :param use_compile: compile the dense submodules with torch.compile
+        :param use_jit: script the MLP networks with TorchScript
+        :param mixed_precision: run the attention layers under BF16 autocast
+        :param fused_kv: compute keys and values with one pairwise network. Checkpoints saved before the fusion
+            have separate key_net / value_net parameters and need fused_kv=False to load.
         """
         super(QM9Model, self).__init__()
+        assert not (use_compile and use_jit), 'use either torch.compile or TorchScript'
         assert pooling in ['max', 'avg', 'sum'], 'Unresolved pooling type ' + pooling
         assert skip_type in ['cat', 'sum', 'gate', 'none']
         self.num_layers = num_layers
@@ -216,6 +183,10 @@ class QM9Model(nn.Module):
         self.recurrent = recurrent
         self.skip_type = skip_type
         self.input_LN = False
+        self.use_compile = use_compile
+        self.use_jit = use_jit
+        self.mixed_precision = mixed_precision
+        self.fused_kv = fused_kv
 
         self._build_net()
 
@@ -233,25 +204,32 @@ class QM9Model(nn.Module):
         m_qk = self.qk_channels
         m_v = self.v_channels
         
+        # rescale the atomic numbers (last raw scalar channel) to the range of the one-hot channels
+        input_scale = torch.ones(1, m_in_scalars, 1)
+        input_scale[:, -1] = 1. / 9.
+        self.register_buffer('input_scale', input_scale, persistent=False)
         self.scalar_embedding = smp_modules.build_MLP_network(in_dim=m_in_scalars, out_dim=m_in['scalar'], 
                                                               archi=embedding_mlp)
 
-        self.GBlock = nn.ModuleList()
+        layers = []
         recurrent_flag = False
+        # separate key and value networks are built when kv_archi is None
+        kv_archi = key_value_mlp if self.fused_kv else None
         for _ in range(self.num_layers):
-            self.GBlock.append(smp_modules.SO3EquivariantAttenRes(m_in=m_in, m_qk=m_qk, m_v=m_v, m_out=m_hidden,
-                                                                  invariant_mod=self.invariant_mod, 
-                                                                  cross_product=self.cross_product,
-                                                                  edge_dim=self.edge_dim, heads=self.heads,
-                                                                  recurrent=recurrent_flag, skip_type=self.skip_type,
-                                                                  recur_drop = {'vec': 0.0, 'scalar': 0.1},
-                                                                  input_LN = False, q_archi=query_mlp,
-                                                                  k_archi=key_mlp, v_archi=value_mlp,
-                                                                  out_archi=skip_mlp,))
-            self.GBlock.append(smp_modules.NormBias(m_in=m_hidden, shifted={'vec': 'LN', 'scalar': 'BN'}, 
-                                                    init={'vec': 'rand', 'scalar': 'zero'}))
+            layers.append(smp_modules.SO3EquivariantAttenRes(m_in=m_in, m_qk=m_qk, m_v=m_v, m_out=m_hidden,
+                                                             invariant_mod=self.invariant_mod, 
+                                                             cross_product=self.cross_product,
+                                                             edge_dim=self.edge_dim, heads=self.heads,
+                                                             recurrent=recurrent_flag, skip_type=self.skip_type,
+                                                             recur_drop = {'vec': 0.0, 'scalar': 0.1},
+                                                             input_LN = False, q_archi=query_mlp,
+                                                             kv_archi=kv_archi, k_archi=key_value_mlp,
+                                                             v_archi=key_value_mlp, out_archi=skip_mlp,))
+            layers.append(smp_modules.NormBias(m_in=m_hidden, shifted={'vec': 'LN', 'scalar': 'BN'}, 
+                                               init={'vec': 'rand', 'scalar': 'zero'}))
             recurrent_flag = self.recurrent
             m_in = m_hidden
+        self.GBlock = smp_modules.GraphSequential(*layers)
         
         self.node_mapping = smp_modules.SO3EquivariantVector(m_in_vec=m_hidden['vec'], m_out_vec=m_out['vec'],
                                                              m_in_s=m_hidden['scalar'], m_out_s=m_out['scalar'],
@@ -259,36 +237,111 @@ class QM9Model(nn.Module):
                                                              cross_product=self.cross_product,
                                                              input_LN=False, net_archi=out_node_graph_mlp)
 
-        if self.pooling == 'max':
-            self.pooling_layer = MaxPooling()
-        elif self.pooling == 'avg':
-            self.pooling_layer = AvgPooling()
-        elif self.pooling == 'sum':
-            self.pooling_layer = SumPooling()
+        self.pooling_layer = smp_modules.ScatterPooling(self.pooling)
         
         self.res_drop = nn.Dropout(p=0.10)
         
         self.graph_mapping = smp_modules.build_MLP_network(in_dim=m_out['scalar'], out_dim=1,
                                                            archi=out_node_graph_mlp)
 
+        if self.use_compile:
+            smp_modules.compile_dense_modules(self)
+        if self.use_jit:
+            smp_modules.script_MLP_networks(self)
+
     def forward(self, G):
-        features = dict()
-        
-        # no input preprocess 
-        features['scalar'] = G.ndata['f']
-        features['scalar'][:, 5, :] = features['scalar'][:, 5, :] / 9.
+        # out-of-place, so that the node features stored in G are left untouched
+        scalar = G.ndata['f'] * self.input_scale
         
         # features = self.embedding(features)
-        features['scalar'] = self.scalar_embedding(features['scalar'][...,0])
-        features['scalar'] = features['scalar'].unsqueeze(-1)
-        features['vec'] = G.ndata['x'].unsqueeze(dim=-2)
+        scalar = self.scalar_embedding(scalar[...,0])
+        features = smp_modules.Feat(vec=G.ndata['x'].unsqueeze(dim=-2), scalar=scalar.unsqueeze(-1))
         
-        for layer in self.GBlock:
-            features = layer(features, G=G)
+        # the input embedding above and the readout below stay in FP32
+        with G.local_scope():
+            smp_modules.cache_graph_structure(G)
+            G.ndata['_batch_idx'] = smp_modules.graph_assignment(G)  # read by the pooling layer
+            with torch.autocast(device_type=G.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision):
+                features = self.GBlock(features, G)
+            features = smp_modules.Feat(*[None if value is None else value.float() for value in features])
 
-        features1 = self.node_mapping(features)['scalar']
-        features = features1 + self.res_drop(features['scalar'])  # Sum
-        features = self.pooling_layer(G, features[..., 0])
+            features1 = self.node_mapping(features).scalar
+            features = dropout_residual(features1, features.scalar, self.res_drop.p, self.training)  # Sum
+            features = self.pooling_layer(G, features[..., 0])
         
         
-        return self.graph_mapping(features)
\ No newline at end of file
+        return self.graph_mapping(features)
+
+
+def quantize_for_inference(model: nn.Module):
+    """
+    Build an int8 CPU copy of a trained model for deployment. The nn.Linear layers of all MLP networks are dynamically
+    quantized to int8 and the MLPs are scripted, frozen and optimized for inference. The norm layers, the attention
+    softmax and the message passing stay in FP32.
+    :param model: a trained NBodyModel or QM9Model, built without use_compile and use_jit
+    :return: the quantized copy, in eval mode on CPU. 'model' is left unchanged.
+    """
+    assert not (model.use_compile or model.use_jit), 'quantize the eager MLP networks of the model'
+    quantized_model = copy.deepcopy(model).cpu().eval()
+    quantized_model.mixed_precision = False  # the int8 kernels take FP32 activations
+    smp_modules.script_MLP_networks(quantized_model, inference=True, quantize=True)
+    return quantized_model
+
+
+class CUDAGraphModel(nn.Module):
+    """Inference wrapper that replays CUDA graphs of the forward of a model.
+
+    One CUDA graph is captured per (num_nodes, num_edges) bucket. On replay, only the node and edge features of the
+    input graph are copied into the captured graph, so the topology of a batched graph has to be determined by its
+    node and edge counts, e.g. the fully connected graphs of the NBody experiment with a fixed number of bodies.
+    """
+
+    def __init__(self, model: nn.Module, warmup_iters: int = 3):
+        """
+        :param model: model to wrap, taking a DGL graph as its only input
+        :param warmup_iters: forward passes run on a side stream before each capture
+        """
+        super(CUDAGraphModel, self).__init__()
+        self.model = model
+        self.warmup_iters = warmup_iters
+        self.captured = {}
+
+    def __repr__(self):
+        return f"CUDAGraphModel(model={self.model}, buckets={list(self.captured.keys())})"
+
+    def _capture(self, G):
+        """
+        Capture the forward of the model on G. G is kept as the static input of the captured graph.
+        :param G: DGL graph on a CUDA device
+        :return: (static input graph, CUDA graph, static output)
+        """
+        stream = torch.cuda.Stream(G.device)
+        stream.wait_stream(torch.cuda.current_stream(G.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.model(G)
+        torch.cuda.current_stream(G.device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self.model(G)
+        return G, graph, static_output
+
+    @torch.no_grad()
+    def forward(self, G):
+        if G.device.type != 'cuda':
+            return self.model(G)
+        assert not self.model.training, 'CUDA graphs are only captured for inference.'
+
+        bucket = (G.num_nodes(), G.num_edges())
+        if bucket not in self.captured:
+            self.captured[bucket] = self._capture(G)
+        static_G, graph, static_output = self.captured[bucket]
+
+        if static_G is not G:
+            for key, value in G.ndata.items():
+                static_G.ndata[key].copy_(value)
+            for key, value in G.edata.items():
+                static_G.edata[key].copy_(value)
+        graph.replay()
+        return static_output.clone()
@@ -8,6 +8,7 @@ from scipy.stats import truncnorm
 import itertools
 import math
 import numpy as np
+from typing import NamedTuple, Optional
 
 import dgl
 import dgl.function as fn
@@ -17,12 +18,23 @@ default_MLP_archi = {}
 global_total_counter = 0
 global_rank2_counter = 0
 
+
+class Feat(NamedTuple):
+    """Vector and scalar features passed between the layers. A field is None if it has no channels."""
+    vec: Optional[torch.Tensor] = None     # B, m_vec, 3
+    scalar: Optional[torch.Tensor] = None  # B, m_s, 1
+
+
+# standard deviation of the standard normal distribution truncated to [-2, 2]
+truncnorm_std = truncnorm.std(a=-2, b=2, loc=0, scale=1)
+
+
 def truncate_normal_initialization(weights, scale=1.0):
     fan_out, fan_in = weights.shape
     scale = scale / max(1, fan_in)
     a = -2
     b = 2
-    std = math.sqrt(scale) / truncnorm.std(a=a, b=b, loc=0, scale=1)
+    std = math.sqrt(scale) / truncnorm_std
     sample_weights = truncnorm.rvs(a=a, b=b, loc=0, scale=std, size=(fan_out * fan_in))
     sample_weights = sample_weights.reshape(fan_out, fan_in)
     with torch.no_grad():
@@ -157,21 +169,24 @@ class SODInvariantScalars(nn.Module):
                  A[..., 0, 0] * A[..., 1, 2] * A[..., 2, 1]
         return output
 
-    def forward(self, features: dict):
+    def forward(self, features: Feat, inner_product: torch.Tensor = None):
         """
-        :param features: dict,
-            'vec': B, m_in_vec, 3
-            'scalar': B, m_in_s, 1
+        :param features: Feat,
+            vec: B, m_in_vec, 3
+            scalar: B, m_in_s, 1
+        :param inner_product: B, m_in_vec * (m_in_vec + 1) / 2, precomputed upper triangular part of the inner
+            product matrix of features.vec (optional)
         :return:
             B, out_dim
         """
         net_input_features = []
 
-        if 'vec' in features:
-            v_mat = features['vec']  # B, m_in_vec, 3
+        if features.vec is not None:
+            v_mat = features.vec  # B, m_in_vec, 3
             B = v_mat.shape[0]
-            inner_product = torch.einsum('...ik, ...jk->...ij', v_mat, v_mat)  # B, m_in_vec, m_in_vec
-            inner_product = inner_product[..., self.triu_idx[0], self.triu_idx[1]]  # B, m_in_vec * (m_in_vec + 1) / 2
+            if inner_product is None:
+                inner_product = torch.einsum('...ik, ...jk->...ij', v_mat, v_mat)  # B, m_in_vec, m_in_vec
+                inner_product = inner_product[..., self.triu_idx[0], self.triu_idx[1]]  # B, m_in_vec * (m_in_vec + 1) / 2
             net_input_features.append(inner_product)
 
             if self.sub_idx is not None:
@@ -180,8 +195,8 @@ class SODInvariantScalars(nn.Module):
                 sub_det = self._compute_determinant(sub_mat)
                 net_input_features.append(sub_det)      # B, (n,3)
 
-        if 'scalar' in features:
-            s_vec = features['scalar'][..., 0]
+        if features.scalar is not None:
+            s_vec = features.scalar[..., 0]
             net_input_features.append(s_vec)
 
         net_input_features = torch.cat(net_input_features, dim=-1)
@@ -219,26 +234,28 @@ class ODInvariantScalars(nn.Module):
         return f"ODInvariantScalars(m_in_vec={self.m_in_vec}, m_in_s={self.m_in_s}, " \
                f"out_dim={self.out_dim}, hidden_dim={self.hidden_dim})"
 
-    def forward(self, features: dict):
+    def forward(self, features: Feat, inner_product: torch.Tensor = None):
         """
-        :param features: dict,
-            'vec': B, m_in_vec, 3
-            'scalar': B, m_in_s, 1 (optional)
+        :param features: Feat,
+            vec: B, m_in_vec, 3
+            scalar: B, m_in_s, 1 (optional)
+        :param inner_product: B, m_in_vec * (m_in_vec + 1) / 2, precomputed upper triangular part of the inner
+            product matrix of features.vec (optional)
         :return:
             B, out_dim
         """
         net_input_features = []
 
-        if 'vec' in features:
-            v_mat = features['vec']     # B, m_in_vec, 3
-            B = v_mat.shape[0]
-            inner_product = torch.einsum('...ik, ...jk->...ij', v_mat, v_mat)   # B, m_in_vec, m_in_vec
-            inner_product = inner_product[..., self.triu_idx[0], self.triu_idx[1]]  # B, m_in_vec * (m_in_vec + 1) / 2
+        if features.vec is not None:
+            if inner_product is None:
+                v_mat = features.vec     # B, m_in_vec, 3
+                inner_product = torch.einsum('...ik, ...jk->...ij', v_mat, v_mat)   # B, m_in_vec, m_in_vec
+                inner_product = inner_product[..., self.triu_idx[0], self.triu_idx[1]]  # B, m_in_vec * (m_in_vec + 1) / 2
             # inner_product = inner_product.reshape(B, self.m_in_vec * self.m_in_vec)
             net_input_features.append(inner_product)
         
-        if 'scalar' in features:
-            s_vec = features['scalar'][..., 0]
+        if features.scalar is not None:
+            s_vec = features.scalar[..., 0]
             net_input_features.append(s_vec)
         
         net_input_features = torch.cat(net_input_features, dim=-1)
@@ -300,24 +317,33 @@ class SO3EquivariantVector(nn.Module):
         return f"SO3EquivariantVector(m_in_vec={self.m_in_vec}, m_out_vec={self.m_out_vec}, m_in_s={self.m_in_s}," \
                f"m_out_s={self.m_out_s})"
 
-    def forward(self, features: dict):
+    def forward(self, features: Feat, inner_product: torch.Tensor = None):
         """
-        :param features: dict
-            'vec': B, m_in_vec, 3
-            'scalar': B, m_in_s, 1 (optional)
-        :return: dict
-            'vec': B, m_out_vec, 3
-            'scalar': B, m_out_s, 1
+        :param features: Feat
+            vec: B, m_in_vec, 3
+            scalar: B, m_in_s, 1 (optional)
+        :param inner_product: precomputed upper triangular part of the inner product matrix of features.vec, see
+            ODInvariantScalars (optional)
+        :return: Feat
+            vec: B, m_out_vec, 3
+            scalar: B, m_out_s, 1
         """
         if self.input_LN:
+            assert inner_product is None, 'the inner products have to be computed after the input layer norm.'
             features = self.input_layer_norm(features)
         
-        weights = self.scalar_nets(features)  # B, out_dim
-        vec_weights, s_weights = torch.split(weights, [self.out_dim_vec, self.out_dim_s], dim=-1)
-        new_features = {}
+        weights = self.scalar_nets(features, inner_product)  # B, out_dim
+        if self.out_dim_vec == 0:
+            # scalar-only output, e.g. gates and the QM9 node readout
+            vec_weights, s_weights = None, weights
+        elif self.out_dim_s == 0:
+            vec_weights, s_weights = weights, None
+        else:
+            vec_weights, s_weights = torch.split(weights, [self.out_dim_vec, self.out_dim_s], dim=-1)
+        new_vec, new_scalar = None, None
 
         if self.out_dim_vec > 0:
-            v_mat = features['vec']
+            v_mat = features.vec
             B = v_mat.shape[0]
             vec_weights = vec_weights.reshape(B, self.m_out_vec, self.m_cross_prod + self.m_in_vec)
             if self.m_in_vec > 1 and self.cross_product:
@@ -329,14 +355,40 @@ class SO3EquivariantVector(nn.Module):
             else:
                 cat_mat = v_mat
              # B, m_out_vec, 3
-            new_features['vec'] = torch.einsum('...ij, ...jk->...ik', vec_weights, cat_mat) / self.normalize_term
+            new_vec = torch.einsum('...ij, ...jk->...ik', vec_weights, cat_mat) / self.normalize_term
 
         if self.out_dim_s > 0:
-            new_features['scalar'] = s_weights.unsqueeze(-1)    # B, m_out_s, 1
+            new_scalar = s_weights.unsqueeze(-1)    # B, m_out_s, 1
 
-        return new_features
+        return Feat(new_vec, new_scalar)
     
 
+def edge_indices(G):
+    """
+    Source and destination node ids of all edges in G, read from the cache of cache_graph_structure when present.
+    :param G: DGL graph
+    :return: src - num_edges, dst - num_edges
+    """
+    if '_src' in G.edata and '_dst' in G.edata:
+        return G.edata['_src'], G.edata['_dst']
+    return G.edges()
+
+
+def cache_graph_structure(G):
+    """
+    Store the node ids of all edges in G.edata['_src'] / G.edata['_dst'] and the relative positions x_dst - x_src in
+    G.edata['_rel'], so that the pairwise convolutions of all layers gather from these tensors instead of going
+    through DGL's edge UDFs for every layer. The keys start with an underscore to keep them apart from the input
+    features. Call it inside 'G.local_scope()' to leave the input graph unchanged.
+    :param G: DGL graph with node positions G.ndata['x'] of shape [num_nodes, 3]
+    :return:
+    """
+    src, dst = G.edges()
+    G.edata['_src'], G.edata['_dst'] = src, dst
+    x = G.ndata['x']
+    G.edata['_rel'] = x[dst] - x[src]  # num_edges, 3
+
+
 class PairwiseSO3Conv(nn.Module):
     """ Generate pairwise features.
     f_ji = h('f_j', 's_j', x_i - x_j, edge_ji)   -> {'vec' , 'scalar'}
@@ -363,60 +415,77 @@ class PairwiseSO3Conv(nn.Module):
         self.net = SO3EquivariantVector(net_in_vec, m_out_vec, net_in_s, m_out_s, invariant_mod, cross_product,
                                         net_archi=net_archi)
 
-    def __repr__(self):
-        return f"PairwiseSO3Conv(m_in_vec={self.m_in_vec}, m_out_vec={self.m_out_vec}, m_in_s={self.m_in_s}," \
-               f"m_out_s={self.m_out_s}, edge_dim={self.edge_dim})"
+        # The inner products among the f_j only depend on the source node. They are computed once per node and
+        # gathered to the edges, so that only the products involving x_i - x_j are computed per edge.
+        self.register_buffer('node_triu_idx', torch.triu_indices(m_in_vec, m_in_vec), persistent=False)
+        self.register_buffer('gram_perm', self._gram_permutation(m_in_vec), persistent=False)
 
-    def udf_edge(self):
-        """Pairwise convolution features. This function is set up as a User Defined Function in DGL.
-        :return:
-            node -> edge function handle
+    @staticmethod
+    def _gram_permutation(m_in_vec: int):
         """
+        Indices ordering cat(node inner products, f_j . (x_i - x_j), |x_i - x_j|^2) as the upper triangular part of the
+        inner product matrix of cat(f_j, x_i - x_j).
+        :param m_in_vec: channels of input vector features
+        :return: (m_in_vec + 1) * (m_in_vec + 2) / 2
+        """
+        num_node_products = int(m_in_vec * (m_in_vec + 1) / 2)
+        node_position = {pair: idx for idx, pair in enumerate(zip(*torch.triu_indices(m_in_vec, m_in_vec).tolist()))}
+        perm = []
+        for i, j in zip(*torch.triu_indices(m_in_vec + 1, m_in_vec + 1).tolist()):
+            if j < m_in_vec:
+                perm.append(node_position[(i, j)])
+            elif i < m_in_vec:
+                perm.append(num_node_products + i)
+            else:
+                perm.append(num_node_products + m_in_vec)
+        return torch.tensor(perm, dtype=torch.long)
 
-        def fnc(edges):
-            input_feat_dict = {}
-            rel = (edges.dst['x'] - edges.src['x'])  # relative distance - num_edges, 3
-
-            vec_feats = []
-            if 'vec' in edges.src:
-                vec_feats.append(edges.src['vec'])  # num_edges, m_in_vec, 3
-            vec_feats.append(rel[:, None, :])
-            input_feat_dict['vec'] = torch.cat(vec_feats, dim=1)  # num_edges, m_in + 1, 3
-
-            add_feat = []
-            if 'scalar' in edges.src:
-                add_feat.append(edges.src['scalar'])  # num_edges, m_in_s, 1
-                assert add_feat[-1].shape[-2] == self.m_in_s
-            if 'w' in edges.data and self.edge_dim != 0:
-                add_feat.append(edges.data['w'].unsqueeze(-1))  # num_edges, edge_dim, 1
-                assert add_feat[-1].shape[-2] == self.edge_dim
-            if len(add_feat) != 0:
-                input_feat_dict['scalar'] = torch.cat(add_feat, dim=-2)  # num_edges, m_in_s + edge_dim, 1
-
-            out_dict = self.net(input_feat_dict)  # num_edges, m_out, 3
-            return out_dict
-
-        return fnc
+    def __repr__(self):
+        return f"PairwiseSO3Conv(m_in_vec={self.m_in_vec}, m_out_vec={self.m_out_vec}, m_in_s={self.m_in_s}," \
+               f"m_out_s={self.m_out_s}, edge_dim={self.edge_dim})"
 
-    def forward(self, features: dict, G):
+    def forward(self, features: Feat, G):
         """
-        :param features: dict, input features
-            'vec' - B, m_in_vec, 3
-            'scalar' - B, m_in_s, 1
+        :param features: Feat, input features
+            vec - B, m_in_vec, 3
+            scalar - B, m_in_s, 1
         :param G: dgl graph object
         :return:
-            dict:
-            'vec' - n_edges, m_out_vec, 3
-            'scalar' - n_edges, m_out_s, 1
+            Feat:
+            vec - n_edges, m_out_vec, 3
+            scalar - n_edges, m_out_s, 1
         """
-        with G.local_scope():
-            if 'vec' in features:
-                G.ndata['vec'] = features['vec']
-            if 'scalar' in features:
-                G.ndata['scalar'] = features['scalar']
-            G.apply_edges(self.udf_edge())
-
-            return {key: G.edata[key] for key in ['vec', 'scalar'] if key in G.edata}
+        src, dst = edge_indices(G)
+        if '_rel' in G.edata:
+            rel = G.edata['_rel']  # cached by cache_graph_structure
+        else:
+            x = G.ndata['x']
+            rel = x[dst] - x[src]  # relative distance - num_edges, 3
+
+        vec_feats = []
+        inner_products = []
+        if features.vec is not None:
+            gram = torch.einsum('...ik, ...jk->...ij', features.vec, features.vec)  # B, m_in_vec, m_in_vec
+            gram = gram[..., self.node_triu_idx[0], self.node_triu_idx[1]]  # B, m_in_vec * (m_in_vec + 1) / 2
+            src_vec = features.vec[src]  # num_edges, m_in_vec, 3
+            vec_feats.append(src_vec)
+            inner_products.append(gram[src])  # num_edges, m_in_vec * (m_in_vec + 1) / 2
+            inner_products.append(torch.einsum('...ik, ...k->...i', src_vec, rel))  # num_edges, m_in_vec
+        vec_feats.append(rel[:, None, :])
+        vec_input = torch.cat(vec_feats, dim=1)  # num_edges, m_in + 1, 3
+        inner_products.append(torch.sum(torch.square(rel), dim=-1, keepdim=True))  # num_edges, 1
+        inner_product = torch.cat(inner_products, dim=-1)[:, self.gram_perm]  # num_edges, (m_in + 1) * (m_in + 2) / 2
+
+        add_feat = []
+        if features.scalar is not None:
+            add_feat.append(features.scalar[src])  # num_edges, m_in_s, 1
+            assert add_feat[-1].shape[-2] == self.m_in_s
+        if 'w' in G.edata and self.edge_dim != 0:
+            add_feat.append(G.edata['w'].unsqueeze(-1))  # num_edges, edge_dim, 1
+            assert add_feat[-1].shape[-2] == self.edge_dim
+        scalar_input = torch.cat(add_feat, dim=-2) if len(add_feat) != 0 else None  # num_edges, m_in_s + edge_dim, 1
+
+        return self.net(Feat(vec_input, scalar_input), inner_product)  # num_edges, m_out, 3
 
 
 class AttentionModule(nn.Module):
@@ -433,60 +502,70 @@ class AttentionModule(nn.Module):
     def __repr__(self):
         return f"AttentionModule(heads={self.heads})"
 
-    def vectorize_dict(self, data_dict):
+    def vectorize_feat(self, data: Feat):
         """
-        Vectorize data in the data_dict and concatenate them together.
-        :param data_dict:
-            'vec': B, m_vec, 3
-            'scalar': B, m_s, 1
+        Vectorize the fields of data and concatenate them together.
+        :param data: Feat
+            vec: B, m_vec, 3
+            scalar: B, m_s, 1
         :return:
             B, heads, m_vec // heads * 3 + m_s // heads * 1
         """
         container = []
-        for key, value in data_dict.items():
+        for value in data:
+            if value is None:
+                continue
             B, m_in, dim = value.shape
             assert m_in % self.heads == 0, 'm_in is not divisible by heads.'
             container.append(value.reshape(B, self.heads, -1))
         return torch.cat(container, dim=-1)
 
-    def forward(self, q: dict, k: dict, v: dict, G, features:dict = None):
-        """
-        :param q: dict, query
-            'vec': B, m_qk_vec, 3
-            'scalar': B, m_qk_s, 1
-        :param k: dict, key
-            'vec': B, m_qk_vec, 3
-            'scalar': B, m_qk_s, 1
-        :param v: dict, value
-            'vec': B, m_v_vec, 3
-            'scalar': B, m_V_s, 1
+    def forward(self, q: Feat, k: Feat, v: Feat, G, features: Feat = None):
+        """
+        :param q: Feat, query
+            vec: B, m_qk_vec, 3
+            scalar: B, m_qk_s, 1
+        :param k: Feat, key
+            vec: B, m_qk_vec, 3
+            scalar: B, m_qk_s, 1
+        :param v: Feat, value
+            vec: B, m_v_vec, 3
+            scalar: B, m_V_s, 1
         :param G:
             A DGL graph
-        :return: dict
-            {'vec': B, m_v_vec, 3,
-            'scalar': B, m_v_s, 1}
+        :return: Feat
+            vec: B, m_v_vec, 3,
+            scalar: B, m_v_s, 1
         """
         with G.local_scope():
-            G.ndata['query'] = self.vectorize_dict(q)    # num_nodes, heads, dim
-            G.edata['key'] = self.vectorize_dict(k)     # num_edges, heads, dim
+            # Under autocast the query and key can come out in different dtypes (e.g. an einsum over a single vector
+            # channel is not lowered to BF16), and e_dot_v needs matching operands, so the logits are computed in FP32.
+            G.ndata['query'] = self.vectorize_feat(q).float()    # num_nodes, heads, dim
+            G.edata['key'] = self.vectorize_feat(k).float()     # num_edges, heads, dim
             div_term = math.sqrt(G.ndata['query'].shape[-1])
 
             # Compute the attention weights
             G.apply_edges(fn.e_dot_v('key', 'query', 'attn'))   # num_edges, heads, 1
             attn = G.edata.pop('attn') / div_term  # num_edges, heads, 1
-            attn = edge_softmax(G, attn)  # num_edges, heads, 1
+            attn = edge_softmax(G, attn)  # num_edges, heads, 1, kept in FP32 under autocast
             attn = self.attn_dropout(attn)
 
-            # Apply attention weights to value embeddings
+            # Apply attention weights to value embeddings. The vectors and scalars are aggregated in a single pass.
+            G.edata['value'] = self.vectorize_feat(v) * attn  # num_edges, heads, dim_v
+            G.update_all(fn.copy_e('value', 'msg'), fn.sum('msg', 'value'))  # num_nodes, heads, dim_v
+            aggregated = G.ndata['value']
+
             output_dict = {}
-            for data_type, data_item in v.items():
+            offset = 0
+            for data_type, data_item in zip(Feat._fields, v):
+                if data_item is None:
+                    continue
                 num_edges, m_in, dim = data_item.shape
-                assert m_in % self.heads == 0, 'm_in is not divisible by heads in the value embedding.'
-                G.edata[data_type] = data_item.reshape(num_edges, self.heads, -1, dim) * attn.unsqueeze(-1)
-                G.update_all(fn.copy_e(data_type, 'msg'), fn.sum('msg', data_type))  # num_nodes, heads, m_in/heads, dim
-                output_dict[data_type] = G.ndata[data_type].reshape(-1, m_in, dim)
+                head_dim = m_in // self.heads * dim
+                output_dict[data_type] = aggregated[..., offset:offset + head_dim].reshape(-1, m_in, dim)
+                offset += head_dim
             
-            return output_dict
+            return Feat(**output_dict)
 
 
 class SO3EquivariantAttenRes(nn.Module):
@@ -498,7 +577,7 @@ class SO3EquivariantAttenRes(nn.Module):
                  edge_dim: int = 0, heads: int = 1, recurrent: bool = False, recur_drop={'vec': 0.0, 'scalar': 0.0},
                  skip_type: str = 'cat', input_LN=False, q_archi: dict = default_MLP_archi,
                  k_archi: dict = default_MLP_archi, v_archi: dict = default_MLP_archi,
-                 out_archi: dict = default_MLP_archi):
+                 out_archi: dict = default_MLP_archi, kv_archi: dict = None):
         """
         :param m_in: dict, channels of input vectors and scalars
         :param m_qk: dict, channels of vectors and scalars in the query and key
@@ -506,6 +585,8 @@ class SO3EquivariantAttenRes(nn.Module):
         :param m_out: dict, channels of output vectors and scalars
         :param edge_dim: dimension of edge features
         :param heads: number of heads in the attention mechanism
+        :param kv_archi: if given, keys and values are computed by a single pairwise network with this architecture
+            (shared hidden layers, concatenated outputs) instead of two networks built from k_archi and v_archi
         """
         super(SO3EquivariantAttenRes, self).__init__()
         self.m_in = m_in
@@ -523,10 +604,16 @@ class SO3EquivariantAttenRes(nn.Module):
 
         self.query_net = SO3EquivariantVector(m_in['vec'], m_qk['vec'], m_in['scalar'], m_qk['scalar'],
                                               invariant_mod, cross_product, net_archi=q_archi)
-        self.key_net = PairwiseSO3Conv(m_in['vec'], m_qk['vec'], m_in['scalar'], m_qk['scalar'], invariant_mod,
-                                       cross_product, edge_dim=edge_dim, net_archi=k_archi)
-        self.value_net = PairwiseSO3Conv(m_in['vec'], m_v['vec'], m_in['scalar'], m_v['scalar'], invariant_mod,
-                                         cross_product, edge_dim=edge_dim, net_archi=v_archi)
+        self.fused_kv = kv_archi is not None
+        if self.fused_kv:
+            self.key_value_net = PairwiseSO3Conv(m_in['vec'], m_qk['vec'] + m_v['vec'], m_in['scalar'],
+                                                 m_qk['scalar'] + m_v['scalar'], invariant_mod, cross_product,
+                                                 edge_dim=edge_dim, net_archi=kv_archi)
+        else:
+            self.key_net = PairwiseSO3Conv(m_in['vec'], m_qk['vec'], m_in['scalar'], m_qk['scalar'], invariant_mod,
+                                           cross_product, edge_dim=edge_dim, net_archi=k_archi)
+            self.value_net = PairwiseSO3Conv(m_in['vec'], m_v['vec'], m_in['scalar'], m_v['scalar'], invariant_mod,
+                                             cross_product, edge_dim=edge_dim, net_archi=v_archi)
         self.attn_mod = AttentionModule(heads)
 
         if self.skip_type == 'cat':
@@ -538,7 +625,7 @@ class SO3EquivariantAttenRes(nn.Module):
             self.out_net = SO3EquivariantVector(m_v['vec'], m_out['vec'], m_v['scalar'], m_out['scalar'], invariant_mod,
                                                 cross_product, net_archi=out_archi)
         elif self.skip_type == 'gate':
-            self.skip_module = SkipGate(m_in, m_v)
+            self.skip_module = SkipGate(m_in, m_v, invariant_mod, cross_product)
             self.out_net = SO3EquivariantVector(m_v['vec'], m_out['vec'], m_v['scalar'], m_out['scalar'], invariant_mod,
                                                 cross_product, net_archi=out_archi)
         elif self.skip_type == 'none':
@@ -556,23 +643,55 @@ class SO3EquivariantAttenRes(nn.Module):
         return f"SO3EquivariantAtten(m_in={self.m_in}, m_qk={self.m_qk}, m_v={self.m_v}, m_out={self.m_out}, " \
                f"edge_dim={self.edge_dim}, heads={self.heads})"
 
-    def forward(self, features: dict, G):
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # The fused key-value network shares its hidden layer between keys and values, so the parameters of separate
+        # key / value networks can not be converted into it. Point at the way to load them instead.
+        if self.fused_kv and any(key.startswith(prefix + 'key_net.') for key in state_dict):
+            error_msgs.append(f'{prefix[:-1]}: the checkpoint has separate key_net / value_net parameters. '
+                              f'Build the model with fused_kv=False (no kv_archi) to load it.')
+        super(SO3EquivariantAttenRes, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                                  missing_keys, unexpected_keys, error_msgs)
+
+    def split_key_value(self, key_value: Feat):
+        """
+        Split the output of the fused key-value network into keys and values.
+        :param key_value: Feat
+            vec - num_edges, m_qk['vec'] + m_v['vec'], 3
+            scalar - num_edges, m_qk['scalar'] + m_v['scalar'], 1
+        :return: keys Feat, values Feat
+        """
+        keys, values = {}, {}
+        for data_type, data_item in zip(Feat._fields, key_value):
+            if data_item is None:
+                continue
+            key_item, value_item = torch.split(data_item, [self.m_qk[data_type], self.m_v[data_type]], dim=-2)
+            if self.m_qk[data_type] != 0:
+                keys[data_type] = key_item
+            if self.m_v[data_type] != 0:
+                values[data_type] = value_item
+        return Feat(**keys), Feat(**values)
+
+    def forward(self, features: Feat, G):
         """
-        :param features: dict
-            'vec' - B, m_in['vec'], 3
-            'scalar' - B, m_in['scalar'], 1
+        :param features: Feat
+            vec - B, m_in['vec'], 3
+            scalar - B, m_in['scalar'], 1
         :param G: graph
-        :return: dict
-            'vec' - B, m_out['vec'], 3
-            'scalar' - B, m_out['scalar'], 1
+        :return: Feat
+            vec - B, m_out['vec'], 3
+            scalar - B, m_out['scalar'], 1
         """
         if self.input_LN:
             features = self.input_layer_norm(features)
 
-        queries = self.query_net(features)  # dict {B, m_qk['vec'], 3; B, m_qk['scalar'], 1}
-        keys = self.key_net(features, G)  # dict {B, m_qk['vec'], 3; B, m_qk['scalar'], 1}
-        values = self.value_net(features, G)  # dict {B, m_v['vec'], 3; B, m_v['scalar'], 1}
-        updated_feat = self.attn_mod(queries, keys, values, G, features)  # dict {B, m_v['vec'], 3; B, m_v['scalar'], 1}
+        queries = self.query_net(features)  # Feat {B, m_qk['vec'], 3; B, m_qk['scalar'], 1}
+        if self.fused_kv:
+            keys, values = self.split_key_value(self.key_value_net(features, G))
+        else:
+            keys = self.key_net(features, G)  # Feat {B, m_qk['vec'], 3; B, m_qk['scalar'], 1}
+            values = self.value_net(features, G)  # Feat {B, m_v['vec'], 3; B, m_v['scalar'], 1}
+        updated_feat = self.attn_mod(queries, keys, values, G, features)  # Feat {B, m_v['vec'], 3; B, m_v['scalar'], 1}
 
         if self.skip_module is not None:
             updated_feat = self.skip_module(features, updated_feat)
@@ -582,48 +701,46 @@ class SO3EquivariantAttenRes(nn.Module):
             # Maybe add drop out on features. Also, it seems that adding features output from layer norm seems not a
             # good idea
             updated_feat = self.recurrent_drop(updated_feat)
-            updated_feat = {key: value + features[key] for key, value in updated_feat.items()}
+            updated_feat = Feat(*[None if value is None else value + residual
+                                  for value, residual in zip(updated_feat, features)])
 
         return updated_feat
 
 
 class SkipCat(nn.Module):
     def __init__(self):
-        """ Concatenate two features dict.
+        """ Concatenate two Feat.
         """
         super(SkipCat, self).__init__()
 
     @staticmethod
-    def forward(features_1: dict, features_2: dict):
+    def forward(features_1: Feat, features_2: Feat):
         updated_feat = {}
-        for data_type in ['vec', 'scalar']:
-            container = []
-            if data_type in features_1:
-                container.append(features_1[data_type])
-            if data_type in features_2:
-                container.append(features_2[data_type])
+        for data_type, item_1, item_2 in zip(Feat._fields, features_1, features_2):
+            container = [item for item in [item_1, item_2] if item is not None]
             if len(container) != 0:
                 updated_feat[data_type] = torch.cat(container, dim=-2)
-        return updated_feat
+        return Feat(**updated_feat)
 
 
 class SkipSum(nn.Module):
     def __init__(self):
-        """ Add two features dict together,
+        """ Add two Feat together,
         """
         super(SkipSum, self).__init__()
 
     @staticmethod
-    def forward(features_1: dict, features_2: dict):
+    def forward(features_1: Feat, features_2: Feat):
         updated_feat = {}
-        for data_type in ['vec', 'scalar']:
+        for data_type, item_1, item_2 in zip(Feat._fields, features_1, features_2):
             tmp_results = 0.
-            if data_type in features_1:
-                tmp_results += features_1[data_type]
-            if data_type in features_2:
-                tmp_results += features_2[data_type]
+            if item_1 is not None:
+                tmp_results += item_1
+            if item_2 is not None:
+                tmp_results += item_2
             if not isinstance(tmp_results, float):
                 updated_feat[data_type] = tmp_results
+        return Feat(**updated_feat)
 
 
 gate_archi = {
@@ -640,32 +757,36 @@ gate_archi = {
 
 
 class SkipGate(nn.Module):
-    def __init__(self, m_in: dict, m_update: dict):
-        """ Gated mechanism.
+    def __init__(self, m_in: dict, m_update: dict, invariant_mod: str, cross_product: bool):
+        """ Gated mechanism. The updated features are scaled channel-wise by gates in (0, 1) computed from the input
+        features, so the output keeps the channels of the update instead of concatenating both.
+        :param m_in: dict, channels of the input features
+        :param m_update: dict, channels of the updated features
         """
         super(SkipGate, self).__init__()
         self.m_in = m_in
         self.m_update = m_update
         self.gate_map = SO3EquivariantVector(m_in_vec=m_in['vec'], m_out_vec=0, m_in_s=m_in['scalar'],
-                                             m_out_s=m_update['vec'] + m_update['scalar'], net_archi=gate_archi)
+                                             m_out_s=m_update['vec'] + m_update['scalar'], invariant_mod=invariant_mod,
+                                             cross_product=cross_product, net_archi=gate_archi)
 
-    def forward(self, features: dict, updated: dict):
+    def forward(self, features: Feat, updated: Feat):
         """
-        :param features: dict
-            'vec': B, m_in['vec'], 3
-            'scalar': B, m_in['scalar'], 1
-        :param updated: dict
-            'vec': B, m_update['vec'], 3
-            'scalar': B, m_update['scalar'], 1
+        :param features: Feat
+            vec: B, m_in['vec'], 3
+            scalar: B, m_in['scalar'], 1
+        :param updated: Feat
+            vec: B, m_update['vec'], 3
+            scalar: B, m_update['scalar'], 1
         :return:
         """
         output = {}
-        gate = self.gate_map(features)['scalar']    # B, m_update['vec'] + m_update['scalar'], 1
-        if 'vec' in updated:
-            output['vec'] = updated['vec'] * gate[:, :self.m_update['vec'], :]
-        if 'scalar' in updated:
-            output['scalar'] = updated['scalar'] * gate[:, self.m_update['vec']:, :]
-        return output
+        gate = self.gate_map(features).scalar    # B, m_update['vec'] + m_update['scalar'], 1
+        if updated.vec is not None:
+            output['vec'] = updated.vec * gate[:, :self.m_update['vec'], :]
+        if updated.scalar is not None:
+            output['scalar'] = updated.scalar * gate[:, self.m_update['vec']:, :]
+        return Feat(**output)
 
 
 class SO3Dropout(nn.Module):
@@ -680,34 +801,39 @@ class SO3Dropout(nn.Module):
         self.dropout_rate = p
         self.dropout_mods = nn.ModuleDict()
         self.eps = 1e-12
+        # channels with a zero dropout rate are passed through as they are, instead of running an identity dropout
+        self.pass_through = []
         for data_type, channel in m_in.items():
             if channel != 0:
-                self.dropout_mods[data_type] = nn.Dropout(p=self.dropout_rate[data_type])
+                if self.dropout_rate[data_type] > 0:
+                    self.dropout_mods[data_type] = nn.Dropout(p=self.dropout_rate[data_type])
+                else:
+                    self.pass_through.append(data_type)
 
     def __repr__(self):
         return f"SO3Dropout(m_in={self.m_in}, dropout_rate={self.dropout_rate})"
 
-    def forward(self, features: dict, **kwargs):
+    def forward(self, features: Feat, **kwargs):
         """
-        :param features: dict
-            'vec': B, m_in['vec'], 3
-            'scalar': B, m_in['scalar'], 1
+        :param features: Feat
+            vec: B, m_in['vec'], 3
+            scalar: B, m_in['scalar'], 1
         :param kwargs:
-        :return: dict
-            'vec': B, m_in['vec'], 3
-            'scalar', B, m_in[scalar'], 1
+        :return: Feat
+            vec: B, m_in['vec'], 3
+            scalar, B, m_in[scalar'], 1
         """
-        new_features = {}
+        new_features = {data_type: getattr(features, data_type) for data_type in self.pass_through}
         if 'vec' in self.dropout_mods:
-            data_item = features['vec']
+            data_item = features.vec
             norm = torch.sqrt(torch.sum(torch.square(data_item), dim=-1, keepdim=True) + self.eps)  # B, m_in[*], 1
             phase = data_item / norm  # B, m_in[*], dim
             transformed = self.dropout_mods['vec'](norm)  # B, m_in[*], 1
             new_features['vec'] = transformed * phase  # B, m_in[*], dim
         if 'scalar' in self.dropout_mods:
-            data_item = features['scalar']  # B, m_in[*], dim
+            data_item = features.scalar  # B, m_in[*], dim
             new_features['scalar'] = self.dropout_mods['scalar'](data_item)  # B, m_in[*], dim
-        return new_features
+        return Feat(**new_features)
 
 
 class NormBias(nn.Module):
@@ -743,34 +869,53 @@ class NormBias(nn.Module):
                     self.shift_module[data_type] = nn.BatchNorm1d(channel)
 
     def __repr__(self):
-        return f"NormBias(m_in={self.m_in}, non_lin={self.non_lin}, shifted={self.shifted})"
+        return f"NormBias(m_in={self.m_in}, non_lin={self.non_lin}, shifted={self.shift_type})"
 
-    def forward(self, features: dict, **kwargs):
+    def shift_and_bias(self, data_type: str, data_item: torch.Tensor):
         """
-        :param features: dict
-            'vec': B, m_in['vec'], 3
-            'scalar': B, m_in['scalar'], 1
-        :param kwargs:
-        :return: dict
-            'vec': B, m_in['vec'], 3
-            'scalar', B, m_in[scalar'], 1
+        Apply the normalization and the learned bias. The bias is folded into the affine shift of the normalization,
+        so that both run as a single F.layer_norm / F.batch_norm call without an extra pass over data_item.
+        :param data_type: 'vec' or 'scalar'
+        :param data_item: B, m_in[data_type]
+        :return: B, m_in[data_type]
+        """
+        bias = self.bias[data_type][0]  # m_in[data_type]
+        if data_type not in self.shift_module:
+            return data_item + bias
+
+        norm_layer = self.shift_module[data_type]
+        if isinstance(norm_layer, nn.LayerNorm):
+            return F.layer_norm(data_item, norm_layer.normalized_shape, norm_layer.weight, norm_layer.bias + bias,
+                                norm_layer.eps)
+
+        # nn.BatchNorm1d with its default momentum and running statistics
+        if self.training:
+            norm_layer.num_batches_tracked.add_(1)
+        return F.batch_norm(data_item, norm_layer.running_mean, norm_layer.running_var, norm_layer.weight,
+                            norm_layer.bias + bias, self.training, norm_layer.momentum, norm_layer.eps)
+
+    def forward(self, features: Feat, G=None):
+        """
+        :param features: Feat
+            vec: B, m_in['vec'], 3
+            scalar: B, m_in['scalar'], 1
+        :param G: unused, for the common (features, G) interface of the layers in a GraphSequential
+        :return: Feat
+            vec: B, m_in['vec'], 3
+            scalar, B, m_in[scalar'], 1
         """
         new_features = {}
         if 'vec' in self.bias:
-            data_item = features['vec']
+            data_item = features.vec
             norm = torch.sqrt(torch.sum(torch.square(data_item), dim=-1) + self.eps)  # B, m_in[*]
             phase = data_item / norm.unsqueeze(-1)  # B, m_in[*], dim
-            if self.shift_type != 'none':
-                norm = self.shift_module['vec'](norm)
-            transformed = self.non_lin(norm + self.bias['vec']).unsqueeze(-1)  # B, m_in[*], 1
+            transformed = self.non_lin(self.shift_and_bias('vec', norm)).unsqueeze(-1)  # B, m_in[*], 1
             new_features['vec'] = transformed * phase  # B, m_in[*], dim
         if 'scalar' in self.bias:
-            data_item = features['scalar'][..., 0]  # B, m_in[*]
-            if self.shift_type != 'none':
-                data_item = self.shift_module['scalar'](data_item)
-            data_item = self.non_lin(data_item + self.bias['scalar'])
+            data_item = features.scalar[..., 0]  # B, m_in[*]
+            data_item = self.non_lin(self.shift_and_bias('scalar', data_item))
             new_features['scalar'] = data_item.unsqueeze(-1)
-        return new_features
+        return Feat(**new_features)
 
 
 class SO3LayerNorm(nn.Module):
@@ -790,24 +935,151 @@ class SO3LayerNorm(nn.Module):
 
     def forward(self, features, **kwargs):
         """
-               :param features: dict
-                   'vec': B, m_in['vec'], 3
-                   'scalar': B, m_in['scalar'], 1
+               :param features: Feat
+                   vec: B, m_in['vec'], 3
+                   scalar: B, m_in['scalar'], 1
                :param kwargs:
-               :return: dict
-                   'vec': B, m_in['vec'], 3
-                   'scalar', B, m_in[scalar'], 1
+               :return: Feat
+                   vec: B, m_in['vec'], 3
+                   scalar, B, m_in[scalar'], 1
                """
         new_features = {}
         if 'vec' in self.LN_modules:
-            data_item = features['vec']     # B, m_in[*], dim
+            data_item = features.vec     # B, m_in[*], dim
             norm = torch.sqrt(torch.sum(torch.square(data_item), dim=-1) + self.eps)  # B, m_in[*]
             phase = data_item / norm.unsqueeze(-1)  # B, m_in[*], dim
             transformed = self.LN_modules['vec'](norm)  # B, m_in[*]
             new_features['vec'] = transformed.unsqueeze(-1) * phase  # B, m_in[*], dim
         if 'scalar' in self.LN_modules:
-            data_item = features['scalar'][..., 0]  # B, m_in[*]
+            data_item = features.scalar[..., 0]  # B, m_in[*]
             data_item = self.LN_modules['scalar'](data_item)    # B, m_in[*]
             new_features['scalar'] = data_item.unsqueeze(-1)    # B, m_in[*], 1
 
-        return new_features
+        return Feat(**new_features)
+
+
+class GraphSequential(nn.Sequential):
+    """A sequential container of graph layers. Every layer is called as layer(features, G) with the same graph. It is
+    the same Python loop as iterating over a ModuleList, just behind a single call; the DGL layers can not be
+    scripted or compiled as a whole."""
+
+    def forward(self, features: Feat, G):
+        """
+        :param features: Feat, input features of the first layer
+        :param G: DGL graph shared by all layers
+        :return: Feat, output features of the last layer
+        """
+        for layer in self:
+            features = layer(features, G)
+        return features
+
+
+def graph_assignment(G):
+    """
+    Index of the graph in the batch that each node of the batched graph G belongs to.
+    :param G: batched DGL graph
+    :return: num_nodes
+    """
+    batch_num_nodes = G.batch_num_nodes()
+    graph_ids = torch.arange(batch_num_nodes.shape[0], device=batch_num_nodes.device)
+    return torch.repeat_interleave(graph_ids, batch_num_nodes, output_size=G.num_nodes())
+
+
+class ScatterPooling(nn.Module):
+    """Graph readout computed with a single scatter_reduce over the node-to-graph assignment. It replaces the
+    SumPooling, AvgPooling and MaxPooling of DGL, avoiding their message passing overhead on small graphs."""
+
+    def __init__(self, pooling: str):
+        """
+        :param pooling: pooling type, ['max', 'avg', 'sum']
+        """
+        super(ScatterPooling, self).__init__()
+        assert pooling in ['max', 'avg', 'sum'], 'Unresolved pooling type ' + pooling
+        self.pooling = pooling
+        self.reduce = {'max': 'amax', 'avg': 'mean', 'sum': 'sum'}[pooling]
+
+    def __repr__(self):
+        return f"ScatterPooling(pooling={self.pooling})"
+
+    def forward(self, G, feat):
+        """
+        :param G: batched DGL graph, optionally with the node-to-graph assignment in G.ndata['_batch_idx']
+        :param feat: num_nodes, dim
+        :return: batch_size, dim
+        """
+        if '_batch_idx' in G.ndata:
+            batch_idx = G.ndata['_batch_idx']  # cached by the model forward
+        else:
+            batch_idx = graph_assignment(G)
+        index = batch_idx.unsqueeze(-1).expand_as(feat)
+        output = feat.new_zeros(G.batch_size, feat.shape[-1])
+        return output.scatter_reduce(0, index, feat, reduce=self.reduce, include_self=False)
+
+
+def _dense_modules(module: nn.Module):
+    """
+    The DGL-free submodules of 'module' that compile_dense_modules compiles, outermost first.
+    :param module: the root module
+    :return: list of modules
+    """
+    dense_modules = []
+    for child in module.children():
+        if type(child) is nn.Sequential or isinstance(child, (SO3EquivariantVector, NormBias)):
+            dense_modules.append(child)
+        else:
+            dense_modules.extend(_dense_modules(child))
+    return dense_modules
+
+
+def compile_dense_modules(module: nn.Module, dynamic: bool = True):
+    """
+    Compile the DGL-free submodules of 'module' with torch.compile. Message passing and edge softmax cause graph
+    breaks, so only the dense MLP / norm blocks around them are compiled.
+    :param module: the root module
+    :param dynamic: compile with dynamic shapes, since node and edge counts vary between mini-batches
+    :return:
+    """
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError('torch.compile requires PyTorch >= 2.0')
+    import torch._dynamo as dynamo  # binds only 'dynamo', so 'torch' stays the module-level name
+    dense_modules = _dense_modules(module)
+
+    # All instances of a class share the code object of their forward, and dynamo guards each compiled entry on the
+    # instance it was traced with. Every instance therefore adds one cache entry per training mode to the same code
+    # object. Past cache_size_limit (8 by default) dynamo silently falls back to eager for the remaining instances,
+    # so the limit is raised to cover all of them in both train and eval mode.
+    num_entries = 2 * len(dense_modules)
+    dynamo_config = dynamo.config
+    dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, num_entries)
+    if hasattr(dynamo_config, 'accumulated_cache_size_limit'):
+        dynamo_config.accumulated_cache_size_limit = max(dynamo_config.accumulated_cache_size_limit, num_entries)
+
+    for child in dense_modules:
+        child.forward = torch.compile(child.forward, dynamic=dynamic)
+
+
+def script_MLP_networks(module: nn.Module, inference: bool = False, quantize: bool = False):
+    """
+    Replace every MLP network (see 'build_MLP_network') inside 'module' by its TorchScript version. The MLPs are
+    pure PyTorch, unlike the DGL message passing around them, so they can be scripted in place.
+    :param module: the root module
+    :param inference: additionally freeze and optimize the scripted MLPs for inference. Parameters are inlined
+    as constants, so only use it on a trained model, after loading its weights.
+    :param quantize: dynamically quantize the nn.Linear layers of the MLPs to int8 before scripting them. The
+    quantized kernels only run on CPU, and it requires 'inference'.
+    :return:
+    """
+    assert inference or not quantize, 'int8 quantization is only supported for inference'
+    for name, child in module.named_children():
+        if type(child) is nn.Sequential:
+            if inference:
+                child = child.eval()
+                if quantize:
+                    child = torch.ao.quantization.quantize_dynamic(child, {nn.Linear}, dtype=torch.qint8)
+                scripted = torch.jit.freeze(torch.jit.script(child))
+                scripted = torch.jit.optimize_for_inference(scripted)
+            else:
+                scripted = torch.jit.script(child)
+            setattr(module, name, scripted)
+        else:
+            script_MLP_networks(child, inference=inference, quantize=quantize)
@@ -0,0 +1,55 @@
+import torch
+
+import dgl
+
+
+def pin_batch(batch):
+    """
+    Copy the tensors of a collated batch to page-locked memory, so that their host to device copies can run
+    asynchronously. The node and edge features of DGL graphs are pinned, their structure is small and stays pageable.
+    :param batch: list of DGL graphs and tensors
+    :return: list of DGL graphs and tensors
+    """
+    pinned = []
+    for item in batch:
+        if isinstance(item, dgl.DGLGraph):
+            for frame in (item.ndata, item.edata):
+                for key, value in list(frame.items()):
+                    frame[key] = value.pin_memory()
+        else:
+            item = item.pin_memory()
+        pinned.append(item)
+    return pinned
+
+
+def prefetch_to_device(dataloader, device):
+    """Iterate over the batches of dataloader moved to device. On a CUDA device, each batch is pinned and the next
+    batch is copied on a side stream while the current one is being processed."""
+    if device.type != 'cuda':
+        for batch in dataloader:
+            yield [item.to(device) for item in batch]
+        return
+
+    stream = torch.cuda.Stream(device)
+
+    def copy_batch(batch):
+        # non_blocking copies only overlap with compute when they come from pinned memory
+        batch = pin_batch(batch)
+        # wait for the work queued on the batches in use, so that the copy does not reuse their memory too early
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            batch = [item.to(device, non_blocking=True) for item in batch]
+            copied = torch.cuda.Event()
+            copied.record(stream)
+        return batch, copied
+
+    next_batch = None
+    for batch in dataloader:
+        batch = copy_batch(batch)
+        if next_batch is not None:
+            torch.cuda.current_stream(device).wait_event(next_batch[1])
+            yield next_batch[0]
+        next_batch = batch
+    if next_batch is not None:
+        torch.cuda.current_stream(device).wait_event(next_batch[1])
+        yield next_batch[0]
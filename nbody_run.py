@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import sys
 import warnings
@@ -19,6 +20,7 @@ from Nbody.nbody_dataloader import RIDataset
 from Nbody.nbody_flags import get_flags
 
 import models as t_pkg
+from modules.data_utils import prefetch_to_device
 torch.autograd.set_detect_anomaly(True)
 
 
@@ -53,10 +55,9 @@ def train_epoch(epoch, model, loss_fnc, dataloader, optimizer, FLAGS):
     loss_epoch = 0
 
     num_iters = len(dataloader)
-    for i, (g, y1, y2) in enumerate(dataloader):
-        g = g.to(FLAGS.device)
-        x_T = y1.to(FLAGS.device).view(-1, 3)
-        v_T = y2.to(FLAGS.device).view(-1, 3)
+    for i, (g, y1, y2) in enumerate(prefetch_to_device(dataloader, FLAGS.device)):
+        x_T = y1.view(-1, 3)
+        v_T = y2.view(-1, 3)
         y = torch.stack([x_T, v_T], dim=1)
 
         optimizer.zero_grad()
@@ -93,12 +94,11 @@ def test_epoch(epoch, model, loss_fnc, dataloader, FLAGS, dT):
     acc_epoch_bll = {k: 0.0 for k in keys}  # for linear baseline
     loss_epoch = 0.0
     total_counter = 0
-    for i, (g, y1, y2) in enumerate(dataloader):
+    for i, (g, y1, y2) in enumerate(prefetch_to_device(dataloader, FLAGS.device)):
         num_batches = y1.shape[0]
-        g = g.to(FLAGS.device)
         x_T = y1.view(-1, 3)
         v_T = y2.view(-1, 3)
-        y = torch.stack([x_T, v_T], dim=1).to(FLAGS.device)
+        y = torch.stack([x_T, v_T], dim=1)
         
         pred = model(g).detach()
         
@@ -171,11 +171,15 @@ def main(FLAGS, UNPARSED_ARGV):
     
     if FLAGS.model == 'MyModel_OD':
         model = t_pkg.NBodyModel(num_layers=FLAGS.num_layers-1, num_hidden_channels=FLAGS.num_channels, 
-                             invariant_mod='OD', cross_product=False)
+                             invariant_mod='OD', cross_product=False, skip_type=FLAGS.skip_type,
+                             use_compile=FLAGS.compile, use_jit=FLAGS.jit, mixed_precision=FLAGS.mixed_precision)
     elif FLAGS.model == 'MyModel_SOD':
         model = t_pkg.NBodyModel(num_layers=FLAGS.num_layers-1, num_hidden_channels=FLAGS.num_channels, 
-                             invariant_mod='SOD', cross_product=True)
+                             invariant_mod='SOD', cross_product=True, skip_type=FLAGS.skip_type,
+                             use_compile=FLAGS.compile, use_jit=FLAGS.jit, mixed_precision=FLAGS.mixed_precision)
     model.to(FLAGS.device)
+    # the fully connected graphs of a batch only depend on the batch size, so their forward can be replayed
+    eval_model = t_pkg.CUDAGraphModel(model) if FLAGS.cuda_graph else model
 
     # Optimizer settings
     optimizer = optim.Adam(model.parameters(), lr=FLAGS.lr)
@@ -185,7 +189,14 @@ def main(FLAGS, UNPARSED_ARGV):
 
     for epoch in range(FLAGS.num_epochs):
         train_epoch(epoch, model, task_loss, train_loader, optimizer, FLAGS)
-        test_acc = test_epoch(epoch, model, task_loss, test_loader, FLAGS, dT)
+        test_acc = test_epoch(epoch, eval_model, task_loss, test_loader, FLAGS, dT)
+
+    if FLAGS.quantize:
+        # the int8 kernels run on CPU
+        cpu_FLAGS = copy.copy(FLAGS)
+        cpu_FLAGS.device = torch.device('cpu')
+        quantized_model = t_pkg.quantize_for_inference(model)
+        test_acc = test_epoch(FLAGS.num_epochs, quantized_model, task_loss.cpu(), test_loader, cpu_FLAGS, dT)
     
     print('Seed: ', FLAGS.seed, ' Channels: ', FLAGS.num_channels, ' Test Acc.: ', test_acc)
     
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import sys
 import warnings
@@ -15,6 +16,7 @@ from torch.utils.data import DataLoader
 from qm9.QM9 import QM9Dataset
 
 import models as t_pkg
+from modules.data_utils import prefetch_to_device
 torch.autograd.set_detect_anomaly(True)
 
 
@@ -26,10 +28,7 @@ def train_epoch(epoch, model, loss_fnc, dataloader, optimizer, scheduler, FLAGS)
     model.train()
 
     num_iters = len(dataloader)
-    for i, (g, y) in enumerate(dataloader):
-        g = g.to(FLAGS.device)
-        y = y.to(FLAGS.device)
-
+    for i, (g, y) in enumerate(prefetch_to_device(dataloader, FLAGS.device)):
         optimizer.zero_grad()
         
         # run model forward and compute loss
@@ -50,10 +49,7 @@ def val_epoch(epoch, model, loss_fnc, dataloader, FLAGS):
     model.eval()
 
     rloss = 0
-    for i, (g, y) in enumerate(dataloader):
-        g = g.to(FLAGS.device)
-        y = y.to(FLAGS.device)
-
+    for i, (g, y) in enumerate(prefetch_to_device(dataloader, FLAGS.device)):
         # run model forward and compute loss
         pred = model(g).detach()
         __, __, rl = loss_fnc(pred, y, use_mean=False)
@@ -68,10 +64,7 @@ def test_epoch(epoch, model, loss_fnc, dataloader, FLAGS):
     model.eval()
 
     rloss = 0
-    for i, (g, y) in enumerate(dataloader):
-        g = g.to(FLAGS.device)
-        y = y.to(FLAGS.device)
-
+    for i, (g, y) in enumerate(prefetch_to_device(dataloader, FLAGS.device)):
         # run model forward and compute loss
         pred = model(g).detach()
         __, __, rl = loss_fnc(pred, y, use_mean=False)
@@ -139,11 +132,13 @@ def main(FLAGS, UNPARSED_ARGV):
     if FLAGS.model == 'MyModel_OD':
         model = t_pkg.QM9Model(num_layers=FLAGS.num_layers, invariant_mod='OD', cross_product=False,
                                pooling=FLAGS.pooling, heads=FLAGS.head, div=FLAGS.div, 
-                               hidden_dim=FLAGS.num_channels).to(FLAGS.device)
+                               hidden_dim=FLAGS.num_channels, use_compile=FLAGS.compile,
+                               use_jit=FLAGS.jit, mixed_precision=FLAGS.mixed_precision).to(FLAGS.device)
     elif FLAGS.model == 'MyModel_SOD':
         model = t_pkg.QM9Model(num_layers=FLAGS.num_layers, invariant_mod='SOD', cross_product=True,
                                pooling=FLAGS.pooling, heads=FLAGS.head, div=FLAGS.div, 
-                               hidden_dim=FLAGS.num_channels).to(FLAGS.device)
+                               hidden_dim=FLAGS.num_channels, use_compile=FLAGS.compile,
+                               use_jit=FLAGS.jit, mixed_precision=FLAGS.mixed_precision).to(FLAGS.device)
     model.to(FLAGS.device)
 
     # Optimizer settings
@@ -169,6 +164,13 @@ def main(FLAGS, UNPARSED_ARGV):
         train_epoch(epoch, model, task_loss, train_loader, optimizer, scheduler, FLAGS)
         val_loss = val_epoch(epoch, model, task_loss, val_loader, FLAGS)
         test_loss = test_epoch(epoch, model, task_loss, test_loader, FLAGS)
+
+    if FLAGS.quantize:
+        # the int8 kernels run on CPU
+        cpu_FLAGS = copy.copy(FLAGS)
+        cpu_FLAGS.device = torch.device('cpu')
+        quantized_model = t_pkg.quantize_for_inference(model)
+        test_loss = test_epoch(FLAGS.num_epochs, quantized_model, task_loss, test_loader, cpu_FLAGS)
     
     print('Task: ', FLAGS.task)
     print('val loss: ', val_loss, '\t test loss', test_loss)
@@ -215,6 +217,14 @@ if __name__ == '__main__':
     # Miscellanea
     parser.add_argument('--num_workers', type=int, default=4, 
             help="Number of data loader workers")
+    parser.add_argument('--compile', action='store_true',
+            help="Compile the dense submodules with torch.compile")
+    parser.add_argument('--jit', action='store_true',
+            help="Script the MLP networks with TorchScript")
+    parser.add_argument('--mixed_precision', action='store_true',
+            help="Run the attention layers under BF16 autocast")
+    parser.add_argument('--quantize', action='store_true',
+            help="Evaluate an int8 quantized CPU copy of the trained model")
 
     # Random seed for both Numpy and Pytorch
     parser.add_argument('--seed', type=int, default=2022)